@@ -1,24 +1,174 @@
 import os
-import json
+import glob
+import hashlib
+import tempfile
 import argparse
 import joblib
+from joblib import Parallel, delayed
 import numpy as np
 import pandas as pd
 import geopandas as gpd
-from shapely.geometry import Point
+import pyogrio
 from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import StandardScaler
 from sklearn.linear_model import LogisticRegression
-from sklearn.ensemble import RandomForestClassifier
+from sklearn.ensemble import HistGradientBoostingClassifier
 from sklearn.metrics import classification_report, roc_auc_score
 from sklearn.utils.class_weight import compute_class_weight
 
+# FIRMS columns parsed straight into their final dtypes. latitude/longitude stay
+# float64: float32 shifts points by up to ~1 m and can flip join labels.
+# acq_date is pinned to str, which pyarrow would otherwise turn into date objects.
+FIRMS_DTYPES = {
+    "acq_date": "str",
+    "acq_time": "int32",
+    "brightness": "float32",
+    "bright_t31": "float32",
+}
+
+# -----------------------------------------------------------
+# STEP 0 — Perimeter Loading (column pushdown, WKB cache, bbox filter)
+# -----------------------------------------------------------
+# Perimeter attributes kept on read: any field containing the acreage token,
+# plus the fire name. Both feed the cache key, as does the layout version.
+PERIMETER_ACRE_TOKEN = "ACRES"
+PERIMETER_NAME_FIELD = "FIRE_NAME"
+PERIMETER_CACHE_VERSION = 1
+
+
+def _perimeter_cache_path(perim_path):
+    """Cache file named perim_<source>_<signature>.npz.
+
+    <source> hashes the perimeter file's path so stale caches for it can be pruned;
+    <signature> covers its mtime and size, the column selection and the cache
+    layout version.
+    """
+    source = hashlib.sha1(os.path.abspath(perim_path).encode("utf-8")).hexdigest()[:12]
+    sig = "|".join([
+        str(os.path.getmtime(perim_path)),
+        str(os.path.getsize(perim_path)),
+        PERIMETER_ACRE_TOKEN,
+        PERIMETER_NAME_FIELD,
+        str(PERIMETER_CACHE_VERSION),
+    ])
+    key = hashlib.sha1(sig.encode("utf-8")).hexdigest()[:12]
+    return os.path.join("outputs", "features", f"perim_{source}_{key}.npz")
+
+
+def _prune_perimeter_caches(cache_path):
+    # Keep one cache per perimeter file: drop the ones for older versions of it
+    prefix = cache_path.rsplit("_", 1)[0]
+    for old in glob.glob(f"{prefix}_*.npz"):
+        if old != cache_path:
+            os.remove(old)
+
+
+def _write_perimeter_cache(cache_path, perims):
+    # WKB blobs are stored back to back with their lengths, and string columns as
+    # fixed-width unicode plus a null mask, so the .npz never holds object arrays
+    wkb = perims.geometry.to_wkb().tolist()
+    columns = [c for c in perims.columns if c != perims.geometry.name]
+    attrs = {}
+    for c in columns:
+        col = perims[c]
+        attrs[f"dtype_{c}"] = np.array(str(col.dtype))
+        if pd.api.types.is_string_dtype(col) or col.dtype == object:
+            attrs[f"null_{c}"] = col.isna().to_numpy()
+            attrs[f"attr_{c}"] = col.fillna("").to_numpy(dtype=str)
+        else:
+            attrs[f"attr_{c}"] = col.to_numpy()
+
+    # Write to a temp file and rename, so an interrupted run never leaves a
+    # truncated cache at the final path
+    cache_dir = os.path.dirname(cache_path)
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=".perim_tmp_", suffix=".npz", dir=cache_dir)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.savez(
+                f,
+                wkb=np.frombuffer(b"".join(wkb), dtype=np.uint8),
+                wkb_len=np.array([len(g) for g in wkb], dtype=np.int64),
+                columns=np.array(columns, dtype=str),
+                **attrs,
+            )
+        os.replace(tmp_path, cache_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def _read_perimeter_cache(cache_path):
+    with np.load(cache_path) as d:
+        ends = np.cumsum(d["wkb_len"])
+        starts = ends - d["wkb_len"]
+        buf = d["wkb"].tobytes()
+        wkb = [buf[s:e] for s, e in zip(starts, ends)]
+
+        data = {}
+        for c in d["columns"].tolist():
+            values = d[f"attr_{c}"]
+            if f"null_{c}" in d.files:
+                values = values.astype(object)
+                values[d[f"null_{c}"]] = None
+            data[c] = pd.Series(values, dtype=str(d[f"dtype_{c}"]))
+    return gpd.GeoDataFrame(data, geometry=gpd.GeoSeries.from_wkb(wkb, crs="EPSG:4326"))
+
+
+def _read_perimeter_file(perim_path):
+    info = pyogrio.read_info(perim_path)
+
+    # Keep acreage + fire name; every other attribute is dropped before it is parsed
+    fields = list(info["fields"])
+    columns = [
+        c for c in fields
+        if PERIMETER_ACRE_TOKEN in c.upper() or c.upper() == PERIMETER_NAME_FIELD
+    ]
+
+    perims = gpd.read_file(perim_path, engine="pyogrio", columns=columns)
+
+    # Detect and reproject CRS if necessary
+    if perims.crs is None:
+        print("⚠️ No CRS detected in perimeters — assuming EPSG:3310 (California Albers).")
+        perims.set_crs(epsg=3310, inplace=True)
+
+    if perims.crs.to_epsg() != 4326:
+        print(f"♻️ Reprojecting perimeters from {perims.crs} → EPSG:4326 ...")
+        perims = perims.to_crs(epsg=4326)
+
+    return perims[perims.geometry.notna()].reset_index(drop=True)
+
+
+def load_perimeters(perim_path, firms_bounds):
+    """Perimeters (acreage + fire name) in EPSG:4326 whose bounds touch the FIRMS extent."""
+    cache_path = _perimeter_cache_path(perim_path)
+    perims = None
+    if os.path.exists(cache_path):
+        try:
+            perims = _read_perimeter_cache(cache_path)
+            print(f"⚡ Using cached perimeters: {cache_path}")
+        except Exception as e:
+            print(f"⚠️ Unreadable perimeter cache ({e}) — deleting and re-reading source.")
+            os.remove(cache_path)
+
+    if perims is None:
+        perims = _read_perimeter_file(perim_path)
+        _write_perimeter_cache(cache_path, perims)
+        _prune_perimeter_caches(cache_path)
+        print(f"💾 Cached perimeters: {cache_path}")
+
+    # The cache holds the whole layer, so any FIRMS extent can reuse it
+    minx, miny, maxx, maxy = firms_bounds
+    return perims.cx[minx:maxx, miny:maxy].reset_index(drop=True)
+
+
 # -----------------------------------------------------------
 # STEP 1 — Spatial Join with Automatic CRS Handling
 # -----------------------------------------------------------
-def spatial_label_points_with_acres(csv_path, perim_geojson_path, acre_threshold=500):
+def spatial_label_points_with_acres(csv_path, perim_geojson_path, acre_threshold=500, save_csv=False):
     print(f"\n📂 Loading FIRMS data from: {csv_path}")
-    df = pd.read_csv(csv_path)
+    # pyarrow engine tokenizes on all cores
+    df = pd.read_csv(csv_path, engine="pyarrow", dtype=FIRMS_DTYPES)
 
     # Convert FIRMS detections into GeoDataFrame (EPSG:4326)
     firms_gdf = gpd.GeoDataFrame(
@@ -29,25 +179,11 @@ def spatial_label_points_with_acres(csv_path, perim_geojson_path, acre_threshold
     print(f"✅ Loaded {len(firms_gdf)} FIRMS detections.")
 
     print(f"\n🔥 Loading CAL FIRE perimeters: {perim_geojson_path}")
-    perims = gpd.read_file(perim_geojson_path)
-
-    # Detect and reproject CRS if necessary
-    if perims.crs is None:
-        print("⚠️ No CRS detected in perimeters — assuming EPSG:3310 (California Albers).")
-        perims.set_crs(epsg=3310, inplace=True)
-
-    if perims.crs.to_epsg() != 4326:
-        print(f"♻️ Reprojecting perimeters from {perims.crs} → EPSG:4326 ...")
-        perims = perims.to_crs(epsg=4326)
+    perims = load_perimeters(perim_geojson_path, firms_gdf.total_bounds)
+    print(f"✅ Loaded {len(perims)} perimeters intersecting the FIRMS extent.")
 
     print(f"✅ CRS check complete — Perimeters: {perims.crs}, FIRMS: {firms_gdf.crs}")
 
-    # Spatial join (each FIRMS point gets perimeter info)
-    joined = gpd.sjoin(firms_gdf, perims, how="left", predicate="within")
-    matched = joined["index_right"].notna().sum()
-    print(f"🔍 Matched FIRMS detections to perimeters: {matched}/{len(joined)} "
-          f"({matched/len(joined)*100:.2f}%)")
-
     # Identify acreage column
     acre_col = None
     for c in perims.columns:
@@ -55,6 +191,18 @@ def spatial_label_points_with_acres(csv_path, perim_geojson_path, acre_threshold
             acre_col = c
             break
 
+    # Perimeters under the threshold can only yield label 0, same as no match,
+    # so drop them before the join to shrink the tree and the predicate tests
+    if acre_col:
+        perims = perims[perims[acre_col] >= acre_threshold]
+        print(f"✂️ Kept {len(perims)} perimeters ≥ {acre_threshold} acres for the join.")
+
+    # Spatial join (each FIRMS point gets perimeter info)
+    joined = gpd.sjoin(firms_gdf, perims, how="left", predicate="within")
+    matched = joined["index_right"].notna().sum()
+    print(f"🔍 Matched FIRMS detections to perimeters: {matched}/{len(joined)} "
+          f"({matched/len(joined)*100:.2f}%)")
+
     # Assign spread labels
     joined["spread_label"] = 0
     if acre_col:
@@ -67,8 +215,14 @@ def spatial_label_points_with_acres(csv_path, perim_geojson_path, acre_threshold
 
     # Save labeled FIRMS data
     os.makedirs("outputs/features", exist_ok=True)
-    joined.to_csv("outputs/features/firms_with_perimeter_labels.csv", index=False)
-    print("💾 Saved: outputs/features/firms_with_perimeter_labels.csv")
+    joined.to_parquet(
+        "outputs/features/firms_with_perimeter_labels.parquet",
+        engine="pyarrow", compression="zstd", index=False
+    )
+    print("💾 Saved: outputs/features/firms_with_perimeter_labels.parquet")
+    if save_csv:
+        joined.to_csv("outputs/features/firms_with_perimeter_labels.csv", index=False)
+        print("💾 Saved: outputs/features/firms_with_perimeter_labels.csv")
 
     # Label distribution check
     dist = joined["spread_label"].value_counts(normalize=True).to_dict()
@@ -85,7 +239,10 @@ def train_and_evaluate(df):
 
     # Select numeric columns for ML
     features = ["brightness", "confidence", "bright_t31"]
-    X = df[features].fillna(0)
+    # float32 is plenty for these readings and halves memory traffic in fit;
+    # build the matrix in one allocation and fill NaNs in place
+    X = df[features].to_numpy(dtype=np.float32)
+    X[np.isnan(X)] = 0
     y = df["spread_label"]
 
     if y.nunique() < 2:
@@ -106,33 +263,41 @@ def train_and_evaluate(df):
     cw_dict = dict(zip(np.unique(y_train), cw))
     print("⚖️ Class weights:", cw_dict)
 
-    # Logistic Regression
-    lr = LogisticRegression(max_iter=1000, class_weight=cw_dict)
-    lr.fit(X_train_scaled, y_train)
+    # Logistic Regression (saga keeps float32 input; lbfgs would upcast to float64)
+    lr = LogisticRegression(solver="saga", max_iter=2000, tol=1e-3, class_weight=cw_dict)
+
+    # Histogram Gradient Boosting (features pre-binned to uint8)
+    hgb = HistGradientBoostingClassifier(
+        max_iter=300, max_depth=8, learning_rate=0.05,
+        class_weight=cw_dict, early_stopping=True, random_state=42
+    )
+
+    # Fit both concurrently: saga runs on one core without the GIL, so it
+    # overlaps with HGB's multithreaded histogram builds instead of queueing
+    lr, hgb = Parallel(n_jobs=2, prefer="threads")(
+        delayed(model.fit)(X_fit, y_train)
+        for model, X_fit in [(lr, X_train_scaled), (hgb, X_train)]
+    )
+
     y_pred_lr = lr.predict(X_test_scaled)
     y_proba_lr = lr.predict_proba(X_test_scaled)[:, 1]
     print("\n=== Logistic Regression ===")
     print("ROC AUC:", roc_auc_score(y_test, y_proba_lr))
     print(classification_report(y_test, y_pred_lr))
 
-    # Random Forest
-    rf = RandomForestClassifier(
-        n_estimators=200, random_state=42, class_weight=cw_dict, n_jobs=-1
-    )
-    rf.fit(X_train, y_train)
-    y_pred_rf = rf.predict(X_test)
-    y_proba_rf = rf.predict_proba(X_test)[:, 1]
-    print("\n=== Random Forest ===")
-    print("ROC AUC:", roc_auc_score(y_test, y_proba_rf))
-    print(classification_report(y_test, y_pred_rf))
+    y_pred_hgb = hgb.predict(X_test)
+    y_proba_hgb = hgb.predict_proba(X_test)[:, 1]
+    print("\n=== Hist Gradient Boosting ===")
+    print("ROC AUC:", roc_auc_score(y_test, y_proba_hgb))
+    print(classification_report(y_test, y_pred_hgb))
 
     # Save models
     os.makedirs("outputs/models", exist_ok=True)
     joblib.dump(lr, "outputs/models/fire_spread_model_lr.joblib")
-    joblib.dump(rf, "outputs/models/fire_spread_model_rf.joblib")
+    joblib.dump(hgb, "outputs/models/fire_spread_model_hgb.joblib")
     print("\n💾 Saved trained models to outputs/models/")
 
-    return rf, lr
+    return hgb, lr
 
 
 # -----------------------------------------------------------
@@ -140,7 +305,8 @@ def train_and_evaluate(df):
 # -----------------------------------------------------------
 def main(args):
     df = spatial_label_points_with_acres(
-        args.csv, args.perimeter_geojson, acre_threshold=args.acre_threshold
+        args.csv, args.perimeter_geojson, acre_threshold=args.acre_threshold,
+        save_csv=args.save_csv
     )
     train_and_evaluate(df)
 
@@ -153,5 +319,6 @@ if __name__ == "__main__":
     parser.add_argument("--csv", type=str, required=True, help="Path to FIRMS CleanedCaliData.csv")
     parser.add_argument("--perimeter-geojson", type=str, required=True, help="Path to CAL FIRE perimeter GeoJSON")
     parser.add_argument("--acre-threshold", type=int, default=500, help="Minimum acres to label as spreading")
+    parser.add_argument("--save-csv", action="store_true", help="Also write the labeled FIRMS data as CSV")
     args = parser.parse_args()
     main(args)